@@ -0,0 +1,73 @@
+"""
+numpy and numba kernels of utils, kept free of pyscript so they can be tested outside of the browser
+"""
+import geomie3d
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:
+    # numba is not available in every pyscript environment, the numpy kernels are used instead
+    njit = None
+
+# falsecolor lookup table sampled from geomie3d, index 0 = minval, index -1 = mxval
+_FC_LUT_SIZE = 1024
+_FC_LUT = np.array(geomie3d.utility.calc_falsecolour(np.linspace(0, 1, _FC_LUT_SIZE).tolist(), 0, 1), dtype=np.float32)
+
+# in both kernels t is clipped to 0-1, so -inf and +inf get the min and max color, and nan gets the min color
+def _permute_zxy_numpy(xyzs):
+    return xyzs[:, [1,2,0]]
+
+def _falsecolor_numpy(vals, minval, mxval, lut):
+    nlut = len(lut)
+    if mxval > minval:
+        t = np.clip((vals - minval) / (mxval - minval), 0, 1)
+    else:
+        # same as geomie3d, vals <= minval are the min color, the rest are the max color
+        t = (vals > minval).astype(np.float64)
+    t = np.where(np.isnan(t), 0, t)
+    idx = (t * (nlut - 1) + 0.5).astype(np.int32)
+    return lut[idx]
+
+def _permute_zxy_loop(xyzs):
+    trsf_xyzs = np.empty_like(xyzs)
+    for i in range(xyzs.shape[0]):
+        trsf_xyzs[i, 0] = xyzs[i, 1]
+        trsf_xyzs[i, 1] = xyzs[i, 2]
+        trsf_xyzs[i, 2] = xyzs[i, 0]
+    return trsf_xyzs
+
+def _falsecolor_loop(vals, minval, mxval, lut):
+    nlut = lut.shape[0]
+    span = mxval - minval
+    rgbs = np.empty((vals.shape[0], 3), dtype=np.float32)
+    for i in range(vals.shape[0]):
+        if span > 0:
+            t = (vals[i] - minval) / span
+        elif vals[i] > minval:
+            t = 1.0
+        else:
+            t = 0.0
+        if np.isnan(t):
+            t = 0.0
+        elif t < 0.0:
+            t = 0.0
+        elif t > 1.0:
+            t = 1.0
+        idx = int(t * (nlut - 1) + 0.5)
+        rgbs[i, 0] = lut[idx, 0]
+        rgbs[i, 1] = lut[idx, 1]
+        rgbs[i, 2] = lut[idx, 2]
+    return rgbs
+
+_permute_zxy = _permute_zxy_numpy
+_falsecolor_kernel = _falsecolor_numpy
+if njit is not None:
+    try:
+        # explicit signatures compile, or load from the cache, at import instead of at the first call
+        _permute_zxy = njit(['float32[:,:](float32[:,:])', 'float64[:,:](float64[:,:])'], cache=True)(_permute_zxy_loop)
+        _falsecolor_kernel = njit('float32[:,:](float64[:], float64, float64, float32[:,:])', cache=True)(_falsecolor_loop)
+    except Exception:
+        # e.g. a stale on-disk cache, the import must not fail because of it, keep the numpy kernels
+        _permute_zxy = _permute_zxy_numpy
+        _falsecolor_kernel = _falsecolor_numpy
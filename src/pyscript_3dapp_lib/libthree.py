@@ -1,8 +1,106 @@
+import warnings
+from typing import Any
+
+import numpy as np
 from pyscript import window
+from pyodide.ffi import to_js
+from js import Object
 
 from pyscript.js_modules import three as THREE
 from pyscript.js_modules.oc import OrbitControls
-from pyscript.js_modules.bg import mergeGeometries
+
+# the 12 edges of a unit cube centred at the origin, as pairs of endpoints
+_UNIT_CUBE_EDGES = np.array([
+    # edges parallel to x
+    [[-0.5, -0.5, -0.5], [0.5, -0.5, -0.5]],
+    [[-0.5, 0.5, -0.5], [0.5, 0.5, -0.5]],
+    [[-0.5, -0.5, 0.5], [0.5, -0.5, 0.5]],
+    [[-0.5, 0.5, 0.5], [0.5, 0.5, 0.5]],
+    # edges parallel to y
+    [[-0.5, -0.5, -0.5], [-0.5, 0.5, -0.5]],
+    [[0.5, -0.5, -0.5], [0.5, 0.5, -0.5]],
+    [[-0.5, -0.5, 0.5], [-0.5, 0.5, 0.5]],
+    [[0.5, -0.5, 0.5], [0.5, 0.5, 0.5]],
+    # edges parallel to z
+    [[-0.5, -0.5, -0.5], [-0.5, -0.5, 0.5]],
+    [[0.5, -0.5, -0.5], [0.5, -0.5, 0.5]],
+    [[-0.5, 0.5, -0.5], [-0.5, 0.5, 0.5]],
+    [[0.5, 0.5, -0.5], [0.5, 0.5, 0.5]],
+], dtype=np.float32)
+# the 8 corners of the unit cube and the index of the corner of each of the 24 edge endpoints
+_CUBE_CORNERS, _CUBE_EDGE_IDX = np.unique(_UNIT_CUBE_EDGES.reshape(-1, 3), axis=0, return_inverse=True)
+_CUBE_EDGE_IDX = _CUBE_EDGE_IDX.reshape(-1).astype(np.uint32)
+# the first edge endpoint that uses each of the corners
+_CUBE_CORNER_FIRST = np.unique(_CUBE_EDGE_IDX, return_index=True)[1]
+
+# materials shared by all the objects created with the same parameters, they are kept for the lifetime of the app.
+# changing or disposing a shared material affects every object using it, the viz_*/create_* functions take shared_material=False to opt out
+_MAT_CACHE: dict[tuple, Any] = {}
+
+def _get_material(kind: str, shared: bool = True, **kwargs) -> Any:
+    """
+    get a cached threejs material, a new material is only created the first time the parameters are used
+
+    Parameters
+    ----------
+    kind : str
+        name of the threejs material e.g. 'MeshBasicMaterial'.
+
+    shared : bool, optional
+        if False, always create a new material that is not stored in the cache, use it when the material is modified per object or for one-off colors that should not stay in the cache. Default = True.
+
+    **kwargs
+        parameters of the material. The color is given as a tuple (r, g, b) and converted to THREE.Color.
+
+    Returns
+    -------
+    Any
+        the threejs material, if shared it is used by every caller with the same parameters, so changing e.g. material.color or calling material.dispose() affects all of them.
+    """
+    key = (kind, tuple(sorted(kwargs.items())))
+    material = _MAT_CACHE.get(key) if shared else None
+    if material is None:
+        if 'color' in kwargs:
+            kwargs['color'] = THREE.Color.new(*kwargs['color'])
+        material = getattr(THREE, kind).new(**kwargs)
+        if shared:
+            _MAT_CACHE[key] = material
+    return material
+
+def _to_f32_js(arr) -> window.Float32Array:
+    """
+    copy an array into a js Float32Array in one buffer copy instead of element by element
+
+    Parameters
+    ----------
+    arr : list | np.ndarray
+        array to convert, it is flattened into the Float32Array.
+
+    Returns
+    -------
+    window.Float32Array
+        js Float32Array with the values of arr
+    """
+    # a flat contiguous buffer is converted by to_js into a typed array of the same dtype
+    a = np.ascontiguousarray(arr, dtype=np.float32).reshape(-1)
+    return to_js(a, create_pyproxies=False)
+
+def _to_u32_js(arr) -> window.Uint32Array:
+    """
+    copy an array into a js Uint32Array in one buffer copy instead of element by element
+
+    Parameters
+    ----------
+    arr : list | np.ndarray
+        array to convert, it is flattened into the Uint32Array.
+
+    Returns
+    -------
+    window.Uint32Array
+        js Uint32Array with the values of arr
+    """
+    a = np.ascontiguousarray(arr, dtype=np.uint32).reshape(-1)
+    return to_js(a, create_pyproxies=False)
 
 def get_renderer():
     """
@@ -14,9 +112,9 @@ def get_renderer():
         renderer
     """
     renderer = THREE.WebGLRenderer.new(antialias=True)
-    renderer.shadowMap.enabled = False
-    renderer.shadowMap.type = THREE.PCFSoftShadowMap
-    renderer.shadowMap.needsUpdate = True
+    # set the attributes in one js call, to_js needs Object.fromEntries to give a js object instead of a Map
+    shadow_map = {'enabled': False, 'type': THREE.PCFSoftShadowMap, 'needsUpdate': True}
+    Object.assign(renderer.shadowMap, to_js(shadow_map, dict_converter=Object.fromEntries))
     return renderer
 
 def get_scene():
@@ -86,18 +184,18 @@ def get_orbit_ctrl(camera: THREE.PerspectiveCamera, renderer: THREE.WebGLRendere
         back point light
     """
     controls = OrbitControls.new(camera, renderer.domElement)
-    controls.enableDamping = True
-    controls.dampingFactor = 0.04
+    ctrl_attribs = {'enableDamping': True, 'dampingFactor': 0.04}
+    Object.assign(controls, to_js(ctrl_attribs, dict_converter=Object.fromEntries))
     return controls
 
-def viz_pts(positions: list, size: float = 0.03, rgb_color: list = [1,1,1]) -> THREE.Points:
+def viz_pts(positions: list | np.ndarray, size: float = 0.03, rgb_color: list = [1,1,1], shared_material: bool = True) -> THREE.Points:
     """
     create threejs point clouds for visualization
 
     Parameters
     ----------
-    positions : list
-        a flat list defined as [x1, y1, z1, x2, y2, z2, ... , xn, yn, zn]
+    positions : list | np.ndarray
+        a flat list or array defined as [x1, y1, z1, x2, y2, z2, ... , xn, yn, zn]
     
     size : float, optional
         the size of the points. Default is 0.03
@@ -105,46 +203,52 @@ def viz_pts(positions: list, size: float = 0.03, rgb_color: list = [1,1,1]) -> T
     rgb_color : list, optional
         list[shape(3)] rgb color in a list.
 
+    shared_material : bool, optional
+        share the cached material with other objects created with the same parameters. Default = True.
+
     Returns
     -------
     points : THREE.Points
         threejs points that can be visualize
     """
-    poss = window.Float32Array.new(positions)
+    poss = _to_f32_js(positions)
     geometry = THREE.BufferGeometry.new()
     geometry.setAttribute('position', THREE.BufferAttribute.new(poss, 3))
 
-    material = THREE.PointsMaterial.new(color = THREE.Color.new(rgb_color[0], rgb_color[1], rgb_color[2]), size = size, sizeAttenuation = True)
+    material = _get_material('PointsMaterial', shared = shared_material, color = tuple(rgb_color[:3]), size = size, sizeAttenuation = True)
     points = THREE.Points.new(geometry, material)
     return points
 
-def viz_pts_color(positions: list[float], colors: list[float], size: float = 0.03) -> THREE.Points:
+def viz_pts_color(positions: list[float] | np.ndarray, colors: list[float] | np.ndarray, size: float = 0.03, shared_material: bool = True) -> THREE.Points:
     """
     create threejs point clouds for visualization
 
     Parameters
     ----------
-    positions : list[float]
-        a flat list defined as [x1, y1, z1, x2, y2, z2, ... , xn, yn, zn]
+    positions : list[float] | np.ndarray
+        a flat list or array defined as [x1, y1, z1, x2, y2, z2, ... , xn, yn, zn]
     
-    colors : list[float]
-        a flat list defined as [r1, g1, b1, r2, g2, b2, ... , rn, gn, bn]
+    colors : list[float] | np.ndarray
+        a flat list or array defined as [r1, g1, b1, r2, g2, b2, ... , rn, gn, bn]
 
     size : float, optional
         the size of the points. Default is 0.03
 
+    shared_material : bool, optional
+        share the cached material with other objects created with the same parameters. Default = True.
+
     Returns
     -------
     points : THREE.Points
         threejs points that can be visualize
     """
-    positions = window.Float32Array.new(positions)
-    colors = window.Float32Array.new(colors)
+    poss = _to_f32_js(positions)
+    cols = _to_f32_js(colors)
     geometry = THREE.BufferGeometry.new()
-    geometry.setAttribute('position', THREE.BufferAttribute.new(positions, 3))
-    geometry.setAttribute('color', THREE.BufferAttribute.new(colors, 3))
+    geometry.setAttribute('position', THREE.BufferAttribute.new(poss, 3))
+    geometry.setAttribute('color', THREE.BufferAttribute.new(cols, 3))
 
-    material = THREE.PointsMaterial.new( size = size, sizeAttenuation = True, vertexColors = True)
+    material = _get_material('PointsMaterial', shared = shared_material, size = size, sizeAttenuation = True, vertexColors = True)
     points = THREE.Points.new(geometry, material)
     return points
 
@@ -171,33 +275,61 @@ def create_color(r: float, g: float, b: float) -> THREE.Color:
     three_color = THREE.Color.new(r,g,b)
     return three_color
 
-def create_tri_mesh(positions: list, rgb_color: list = [0.8, 0.8, 0.8]) -> THREE.Mesh:
+def create_tri_mesh(positions: list | np.ndarray | bytes, rgb_color: list = [0.8, 0.8, 0.8], smooth_normals: bool = False, shared_material: bool = True) -> THREE.Mesh:
     """
     create threejs color
 
     Parameters
     ----------
-    positions : list
-        a flat list with original shape list[shape(n,3,3)], n=ntriangles, each tri has 3 points and each point has 3 vertices. 
+    positions : list | np.ndarray | bytes
+        a flat list or array with original shape list[shape(n,3,3)], n=ntriangles, each tri has 3 points and each point has 3 vertices. Can also be the flat float32 bytes e.g. "xyzs_bytes" from read_stl_web.
 
     rgb_color : list, optional
         list[shape(3)] rgb color in a list.
 
+    smooth_normals : bool, optional
+        if True, the vertices shared by the triangles are merged into an indexed geometry with smoothed normals, this uploads less data but rounds off hard edges. Default = False, each triangle keeps its flat face normal.
+
+    shared_material : bool, optional
+        share the cached material with other objects created with the same parameters. Default = True.
+
     Returns
     -------
     three_mesh : THREE.Mesh
         threejs mesh 
     """
-    poss = window.Float32Array.new(positions)
-    geometry = THREE.BufferGeometry.new()
-    geometry.setAttribute('position', THREE.BufferAttribute.new(poss, 3))
-    geometry.computeVertexNormals()
+    if isinstance(positions, (bytes, bytearray, memoryview)):
+        pos = np.frombuffer(positions, dtype=np.float32).reshape(-1, 3, 3)
+    else:
+        pos = np.asarray(positions, dtype=np.float32).reshape(-1, 3, 3)
+    # the face normal is computed once per triangle
+    v10 = pos[:, 1] - pos[:, 0]
+    v20 = pos[:, 2] - pos[:, 0]
+    face_nrmls = np.cross(v10, v20)
 
-    material = THREE.MeshBasicMaterial.new(color = THREE.Color.new(rgb_color[0], rgb_color[1], rgb_color[2]))
+    geometry = THREE.BufferGeometry.new()
+    if smooth_normals:
+        # share the vertices of the triangle soup with an index buffer, the face normals are summed into the shared vertices
+        uniq, inv = np.unique(pos.reshape(-1, 3), axis=0, return_inverse=True)
+        inv = inv.reshape(-1)
+        nrmls = np.zeros_like(uniq)
+        np.add.at(nrmls, inv, np.repeat(face_nrmls, 3, axis=0))
+        nrmls /= np.linalg.norm(nrmls, axis=1, keepdims=True) + 1e-20
+        geometry.setAttribute('position', THREE.BufferAttribute.new(_to_f32_js(uniq), 3))
+        geometry.setAttribute('normal', THREE.BufferAttribute.new(_to_f32_js(nrmls), 3))
+        geometry.setIndex(THREE.BufferAttribute.new(_to_u32_js(inv), 1))
+    else:
+        # the triangle soup keeps its flat shading, the face normal is given to the 3 vertices of the triangle
+        face_nrmls /= np.linalg.norm(face_nrmls, axis=1, keepdims=True) + 1e-20
+        nrmls = np.repeat(face_nrmls[:, None, :], 3, axis=1)
+        geometry.setAttribute('position', THREE.BufferAttribute.new(_to_f32_js(pos), 3))
+        geometry.setAttribute('normal', THREE.BufferAttribute.new(_to_f32_js(nrmls), 3))
+
+    material = _get_material('MeshBasicMaterial', shared = shared_material, color = tuple(rgb_color[:3]))
     mesh = THREE.Mesh.new(geometry, material)
 
     edges = THREE.EdgesGeometry.new(geometry)
-    line_material = THREE.LineBasicMaterial.new(color = THREE.Color.new(1,1,1))
+    line_material = _get_material('LineBasicMaterial', shared = shared_material, color = (1, 1, 1))
     geom_outline = THREE.LineSegments.new(edges, line_material)
     return mesh, geom_outline
 
@@ -213,7 +345,7 @@ def create_grp():
     grp = THREE.Group.new()
     return grp
 
-def create_cube(sx: float = 1, sy: float = 1, sz: float = 1, r: float = 0.5, g: float = 0.5, b: float = 0.5):
+def create_cube(sx: float = 1, sy: float = 1, sz: float = 1, r: float = 0.5, g: float = 0.5, b: float = 0.5, shared_material: bool = True):
     """
     create threejs cube
 
@@ -237,6 +369,9 @@ def create_cube(sx: float = 1, sy: float = 1, sz: float = 1, r: float = 0.5, g:
     b: float, optional
         b of rgb, default = 0.5.
 
+    shared_material: bool, optional
+        share the cached material with other objects created with the same parameters. Default = True.
+
     Returns
     -------
     THREE.Mesh
@@ -246,16 +381,61 @@ def create_cube(sx: float = 1, sy: float = 1, sz: float = 1, r: float = 0.5, g:
         threejs line segments of the cube
     """
     geometry = THREE.BoxGeometry.new(sx, sy, sz)
-    material = THREE.MeshBasicMaterial.new(color = THREE.Color.new(r, g, b))
+    material = _get_material('MeshBasicMaterial', shared = shared_material, color = (r, g, b))
     cube = THREE.Mesh.new(geometry, material)
-    # generate the edges of a cube
-    edges = THREE.EdgesGeometry.new(geometry)
-    line_material = THREE.LineBasicMaterial.new(color = THREE.Color.new(1,1,1))
+    # generate the edges of a cube from the unit cube template instead of extracting them from the triangles
+    edges = THREE.BufferGeometry.new()
+    edges.setAttribute('position', THREE.BufferAttribute.new(_to_f32_js(_CUBE_CORNERS * [sx, sy, sz]), 3))
+    edges.setIndex(THREE.BufferAttribute.new(_to_u32_js(_CUBE_EDGE_IDX), 1))
+    line_material = _get_material('LineBasicMaterial', shared = shared_material, color = (1, 1, 1))
     cube_edges = THREE.LineSegments.new(edges, line_material)
     
     return cube, cube_edges
 
-def create_sphere(radius: float, width_segs: int, height_segs: int, r: float = 0.5, g: float = 0.5, b: float = 0.5) -> THREE.Mesh:
+def create_cubes_instanced(midpts: list[list[float]], sx: float, sy: float, sz: float, colors: list[list[float]] | np.ndarray, shared_material: bool = True) -> THREE.InstancedMesh:
+    """
+    create many threejs cubes of the same size drawn with a single draw call
+
+    Parameters
+    ----------
+    midpts : list[list[float]]
+        list[shape(npts, 3)], a list of the midpts of the cubes
+
+    sx: float
+        x size of the cubes.
+
+    sy: float
+        y size of the cubes.
+
+    sz: float
+        z size of the cubes.
+
+    colors : list[list[float]] | np.ndarray
+        list[shape(npts, 3)], rgb color of each cube, a flat list e.g. from rgb_falsecolors is also accepted.
+
+    shared_material : bool, optional
+        share the cached material with other objects created with the same parameters. Default = True.
+
+    Returns
+    -------
+    THREE.InstancedMesh
+        threejs instanced mesh of the cubes
+    """
+    mid = np.asarray(midpts, dtype=np.float32).reshape(-1, 3)
+    ncubes = len(mid)
+    # column major translation matrices of all the instances
+    mats = np.tile(np.eye(4, dtype=np.float32).reshape(-1), (ncubes, 1))
+    mats[:, 12:15] = mid
+
+    geometry = THREE.BoxGeometry.new(sx, sy, sz)
+    material = _get_material('MeshBasicMaterial', shared = shared_material, color = (1, 1, 1))
+    cubes = THREE.InstancedMesh.new(geometry, material, ncubes)
+    cubes.instanceMatrix.array.set(_to_f32_js(mats))
+    cubes.instanceMatrix.needsUpdate = True
+    cubes.instanceColor = THREE.InstancedBufferAttribute.new(_to_f32_js(colors), 3)
+    return cubes
+
+def create_sphere(radius: float, width_segs: int, height_segs: int, r: float = 0.5, g: float = 0.5, b: float = 0.5, shared_material: bool = True) -> THREE.Mesh:
     """
     create threejs cube
 
@@ -279,41 +459,47 @@ def create_sphere(radius: float, width_segs: int, height_segs: int, r: float = 0
     b: float, optional
         b of rgb, default = 0.5.
 
+    shared_material: bool, optional
+        share the cached material with other objects created with the same parameters. Default = True.
+
     Returns
     -------
     THREE.Mesh
         threejs mesh of the sphere
     """
     geometry = THREE.SphereGeometry.new(radius, width_segs, height_segs)
-    material = THREE.MeshBasicMaterial.new(color = THREE.Color.new(r, g, b))
+    material = _get_material('MeshBasicMaterial', shared = shared_material, color = (r, g, b))
     sphere = THREE.Mesh.new( geometry, material)
     return sphere
 
-def create_lines(positions: list, rgb_color: list = [1,1,1]) -> THREE.LineSegments:
+def create_lines(positions: list | np.ndarray, rgb_color: list = [1,1,1], shared_material: bool = True) -> THREE.LineSegments:
     """
     create threejs lines segment
 
     Parameters
     ----------
-    positions : list
-        a flat list defined as [x1, y1, z1, x2, y2, z2, ... , xn, yn, zn]
+    positions : list | np.ndarray
+        a flat list or array defined as [x1, y1, z1, x2, y2, z2, ... , xn, yn, zn]
 
     rgb_color : list, optional
         list[shape(3)] rgb color in a list.
 
+    shared_material : bool, optional
+        share the cached material with other objects created with the same parameters. Default = True.
+
     Returns
     -------
     THREE.LineSegments
         threejs lines that can be visualize
     """
-    positions = window.Float32Array.new(positions)
+    poss = _to_f32_js(positions)
     geometry = THREE.BufferGeometry.new()
-    geometry.setAttribute( "position", THREE.Float32BufferAttribute.new(positions, 3))
-    material = THREE.LineBasicMaterial.new(color = THREE.Color.new(rgb_color[0], rgb_color[1], rgb_color[2]))
+    geometry.setAttribute( "position", THREE.Float32BufferAttribute.new(poss, 3))
+    material = _get_material('LineBasicMaterial', shared = shared_material, color = tuple(rgb_color[:3]))
     lines = THREE.LineSegments.new(geometry, material)
     return lines
 
-def viz_vox_outlines(midpts: list[list[float]], colors: list[list[float]], vox_dim: float) -> list[THREE.LineSegments]:
+def viz_vox_outlines(midpts: list[list[float]], colors: list[list[float]] | np.ndarray, vox_dim: float, shared_material: bool = True) -> THREE.LineSegments:
     """
     create outlines for voxels
 
@@ -322,31 +508,46 @@ def viz_vox_outlines(midpts: list[list[float]], colors: list[list[float]], vox_d
     midpts : list[list[float]]
         list[shape(npts, 3)], a list of the midpts of the voxels
     
-    colors : list[list[float]]
-        list[shape(npts, 12 * 2 * 3)], a flat list defined as [r1, g1, b1, r2, g2, b2, ... , rn, gn, bn]
+    colors : list[list[float]] | np.ndarray
+        list[shape(npts, 3)], one rgb color per voxel e.g. the output of rgb_falsecolors, this is the recommended layout.
+        list[shape(npts, 12 * 2 * 3)] is deprecated, it is a flat list defined as [r1, g1, b1, r2, g2, b2, ... , rn, gn, bn] for each edge endpoint.
+        The endpoints are no longer in the EdgesGeometry(BoxGeometry) order, they are in the order of _UNIT_CUBE_EDGES: the 4 edges parallel to x, then y, then z, each edge from its -ve to its +ve end.
+        The edges share the 8 corners of the voxel, so each corner takes the color of the first endpoint on it and only a single color per voxel is reproduced exactly.
 
     vox_dim : float
         the size of the voxels.
 
+    shared_material : bool, optional
+        share the cached material with other objects created with the same parameters. Default = True.
+
     Returns
     -------
     THREE.LineSegments
         threejs line segments of the voxels
     """
-    geometries = []
-    for cnt,midpt in enumerate(midpts):
-        cube = THREE.BoxGeometry.new(vox_dim, vox_dim, vox_dim)
-        midpt = window.Float32Array.new(midpt)
-        cube.applyMatrix4(THREE.Matrix4.new().makeTranslation(midpt[0], midpt[1], midpt[2]))
-        # edges geometry
-        edge_geom = THREE.EdgesGeometry.new(cube)
-        color = colors[cnt]
-        color = window.Float32Array.new(color)
-        edge_geom.setAttribute('color', THREE.BufferAttribute.new(color, 3))
-        outline = THREE.LineSegments.new(edge_geom, THREE.LineBasicMaterial.new(vertexColors = True))
-        geometries.append(edge_geom)
-
-    # merge, preserving the color attribute
-    merged_edges = mergeGeometries(geometries, True)
-    outline = THREE.LineSegments.new(merged_edges, THREE.LineBasicMaterial.new(vertexColors = True))
-    return outline
\ No newline at end of file
+    # all the voxels are computed in one pass and uploaded as a single indexed geometry
+    mid = np.asarray(midpts, dtype=np.float32).reshape(-1, 3)
+    nvox = len(mid)
+    nendpts = len(_UNIT_CUBE_EDGES) * 2
+    cols = np.asarray(colors, dtype=np.float32)
+    if nvox == 0:
+        cols = np.zeros((0, len(_CUBE_CORNERS), 3), dtype=np.float32)
+    elif cols.size == nvox * 3:
+        # one color per voxel, tile it to the corners in one go
+        cols = np.repeat(cols.reshape(nvox, 1, 3), len(_CUBE_CORNERS), axis=1)
+    elif cols.size == nvox * nendpts * 3:
+        warnings.warn('colors with a color per edge endpoint are deprecated, give one rgb color per voxel', DeprecationWarning, stacklevel=2)
+        cols = cols.reshape(nvox, nendpts, 3)[:, _CUBE_CORNER_FIRST]
+    else:
+        raise ValueError(f'colors must have 3 or {nendpts * 3} values per voxel, got {cols.size} values for {nvox} voxels')
+    verts = _CUBE_CORNERS[None] * vox_dim + mid[:, None, :]
+    idxs = _CUBE_EDGE_IDX[None] + np.arange(nvox, dtype=np.uint32)[:, None] * len(_CUBE_CORNERS)
+
+    pos_f32 = _to_f32_js(verts)
+    col_f32 = _to_f32_js(cols)
+    geometry = THREE.BufferGeometry.new()
+    geometry.setAttribute('position', THREE.BufferAttribute.new(pos_f32, 3))
+    geometry.setAttribute('color', THREE.BufferAttribute.new(col_f32, 3))
+    geometry.setIndex(THREE.BufferAttribute.new(_to_u32_js(idxs), 1))
+    outline = THREE.LineSegments.new(geometry, _get_material('LineBasicMaterial', shared = shared_material, vertexColors = True))
+    return outline
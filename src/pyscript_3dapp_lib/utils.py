@@ -2,13 +2,17 @@ import io
 import csv
 import geomie3d
 import numpy as np
+from numpy.lib import recfunctions
 from stl import mesh
 from plyfile import PlyData, PlyElement
 
-from pyscript import document
-from js import Uint8Array, File, URL
+from pyscript import document, workers
+from pyodide.ffi import to_js
+from js import File, URL, Object
 
-def convertxyz2zxy(xyzs: np.ndarray) -> np.ndarray:
+from ._kernels import _FC_LUT, _permute_zxy, _falsecolor_kernel
+
+def convertxyz2zxy(xyzs: np.ndarray, use_trsf: bool = False) -> np.ndarray:
     """
     convert xyzs from xyz cs to zxy coordinates
 
@@ -17,16 +21,27 @@ def convertxyz2zxy(xyzs: np.ndarray) -> np.ndarray:
     xyzs : np.ndarray
         np.ndarray[shape(npoints, 3)] 
 
+    use_trsf : bool, optional
+        if True, compute the conversion with the general geomie3d cs2cs transformation instead of the axis permutation, use it to verify the results. Default = False.
+
     Returns
     -------
     np.ndarray
         np.ndarray[shape(npoints, 3)]
     """
-    orig_cs = geomie3d.utility.CoordinateSystem([0,0,0], [1,0,0], [0,1,0])
-    dest_cs = geomie3d.utility.CoordinateSystem([0,0,0], [0,0,1], [1,0,0])
-    trsf_mat = geomie3d.calculate.cs2cs_matrice(orig_cs, dest_cs)
-    trsf_xyzs = geomie3d.calculate.trsf_xyzs(xyzs, trsf_mat)
-    return trsf_xyzs
+    if use_trsf:
+        orig_cs = geomie3d.utility.CoordinateSystem([0,0,0], [1,0,0], [0,1,0])
+        dest_cs = geomie3d.utility.CoordinateSystem([0,0,0], [0,0,1], [1,0,0])
+        trsf_mat = geomie3d.calculate.cs2cs_matrice(orig_cs, dest_cs)
+        trsf_xyzs = geomie3d.calculate.trsf_xyzs(xyzs, trsf_mat)
+        return trsf_xyzs
+    # the cs2cs matrice between the two cs is a constant permutation matrice, [x,y,z] -> [y,z,x]
+    xyzs = np.asarray(xyzs)
+    if xyzs.dtype != np.float32:
+        xyzs = xyzs.astype(np.float64)
+    # the kernels work on 2d arrays of points, the original shape is restored after
+    trsf_xyzs = _permute_zxy(xyzs.reshape(-1, 3))
+    return trsf_xyzs.reshape(xyzs.shape)
 
 def read_csv_web(grid_bytes: bytes) -> list:
     """
@@ -64,12 +79,15 @@ def read_stl_web(stl_bytes: bytes) -> dict:
     dict
         A dictionary containing:
             - "xyzs": np.ndarray[(n_triangles, 3, 3)].
+            - "xyzs_bytes": memoryview, the xyzs as flat float32 bytes that can be given directly to create_tri_mesh.
     """
     stl_bytes = stl_bytes.to_py()
     stl_bstream = io.BytesIO(stl_bytes)
     stl_mesh = mesh.Mesh.from_file('', fh=stl_bstream)
     mesh_data = stl_mesh.vectors
-    return {'xyzs': mesh_data}
+    # a byte view instead of tobytes, so the xyzs are not copied again
+    mesh_bytes = memoryview(np.ascontiguousarray(mesh_data, dtype=np.float32)).cast('B')
+    return {'xyzs': mesh_data, 'xyzs_bytes': mesh_bytes}
 
 def read_ply_web(ply_bytes: bytes) -> dict:
     """
@@ -89,11 +107,77 @@ def read_ply_web(ply_bytes: bytes) -> dict:
     bstream = io.BytesIO(ply_bytes)
     plydata = PlyData.read(bstream)
     data = plydata['vertex'].data
-    data = list(map(list, data))
-    data = np.array(data)
+    # view the structured array as a 2d array of the attributes' common dtype
+    data = recfunctions.structured_to_unstructured(data)
     return data
 
-def write_ply_web(vertex_data: list[tuple], dtype_val: list[tuple]) -> io.BytesIO:
+def parse_file_worker(file_bytes: bytes, kind: str):
+    """
+    parse a stl, ply or csv file, to be exported from a pyscript worker so that the parsing does not block the main thread.
+    In the worker script: from pyscript_3dapp_lib.utils import parse_file_worker; __export__ = ['parse_file_worker']
+
+    Parameters
+    ----------
+    file_bytes: bytes
+        JS bytes from the file specified, e.g. the ArrayBuffer from item.arrayBuffer().
+
+    kind: str
+        the type of the file, 'stl', 'ply' or 'csv'.
+
+    Returns
+    -------
+    JS Object
+        the parsed data as js typed arrays, converted back to python by read_file_in_worker.
+    """
+    if kind == 'stl':
+        # only the triangles are sent back, the xyzs_bytes of read_stl_web are rebuilt on the main thread
+        stl_mesh = mesh.Mesh.from_file('', fh=io.BytesIO(file_bytes.to_py()))
+        result = {'xyzs': np.ascontiguousarray(stl_mesh.vectors, dtype=np.float32).reshape(-1)}
+    elif kind == 'ply':
+        data = np.ascontiguousarray(read_ply_web(file_bytes))
+        result = {'data': data.reshape(-1), 'shape': list(data.shape), 'dtype': data.dtype.str}
+    elif kind == 'csv':
+        result = {'rows': read_csv_web(file_bytes)}
+    else:
+        raise ValueError(f"file kind {kind} is not supported, use 'stl', 'ply' or 'csv'")
+    return to_js(result, dict_converter=Object.fromEntries)
+
+async def read_file_in_worker(file_bytes: bytes, kind: str, worker_name: str = 'parser'):
+    """
+    parse a stl, ply or csv file in the named pyscript worker that exports parse_file_worker, the main thread keeps rendering while the file is parsed.
+
+    Parameters
+    ----------
+    file_bytes: bytes
+        JS bytes from the file specified, e.g. the ArrayBuffer from item.arrayBuffer().
+
+    kind: str
+        the type of the file, 'stl', 'ply' or 'csv'.
+
+    worker_name: str, optional
+        the name of the pyscript worker, <script type="py" worker name="parser">. Default = 'parser'.
+
+    Returns
+    -------
+    dict | np.ndarray | list
+        the same output as read_stl_web, read_ply_web or read_csv_web respectively.
+    """
+    worker = await workers[worker_name]
+    result = await worker.parse_file_worker(file_bytes, kind)
+    if kind == 'stl':
+        # copy the typed arrays straight into numpy arrays
+        xyzs = np.empty(result.xyzs.length, dtype=np.float32)
+        result.xyzs.assign_to(xyzs)
+        # xyzs_bytes is a byte view of xyzs, not a copy
+        return {'xyzs': xyzs.reshape(-1, 3, 3), 'xyzs_bytes': memoryview(xyzs).cast('B')}
+    elif kind == 'ply':
+        data = np.empty(result.data.length, dtype=result.dtype)
+        result.data.assign_to(data)
+        return data.reshape(result.shape.to_py())
+    else:
+        return result.rows.to_py()
+
+def write_ply_web(vertex_data: list[tuple], dtype_val: list[tuple], text: bool = False) -> io.BytesIO:
     """
     write ply file for webapp
 
@@ -105,6 +189,9 @@ def write_ply_web(vertex_data: list[tuple], dtype_val: list[tuple]) -> io.BytesI
     dtype_val: list[tuple]
         example of dtype_val = [('x', 'f4'), ('y', 'f4'), ('z', 'f4'), ('temperature', 'f4')]
 
+    text: bool, optional
+        if True, write an ascii ply file, else write a binary little endian ply file. Default = False.
+
     Returns
     -------
     io.BytesIO
@@ -112,7 +199,7 @@ def write_ply_web(vertex_data: list[tuple], dtype_val: list[tuple]) -> io.BytesI
     """
     ply_vertex_data = np.array(vertex_data, dtype=dtype_val)
     element = PlyElement.describe(ply_vertex_data, 'vertex')
-    ply = PlyData([element], text=True)
+    ply = PlyData([element], text=text, byte_order='<')
 
     # Write to BytesIO
     buffer = io.BytesIO()
@@ -125,22 +212,24 @@ def write_csv_web(rows: list[list]) -> io.BytesIO:
 
     Parameters
     ----------
-    rows: list[list]
-        rows to write to csv
+    rows: list[list] | np.ndarray
+        rows to write to csv. A 2d integer np.ndarray is written by numpy, all other rows are written by the csv module.
 
     Returns
     -------
     io.BytesIO
         bufferstream to be written to file in the create_hidden_link function 
     """
-    # Create a bytes buffer
     buffer = io.BytesIO()
-    # Wrap it in a text wrapper for the csv module
-    text_buffer = io.TextIOWrapper(buffer, encoding='utf-8', newline='')
-    writer = csv.writer(text_buffer)
-    writer.writerows(rows)
-    text_buffer.flush()
-    text_buffer.detach()
+    if isinstance(rows, np.ndarray) and rows.ndim == 2 and rows.dtype.kind in 'iu':
+        # integers are written the same by numpy as by the csv module, in one pass
+        np.savetxt(buffer, rows, fmt='%d', delimiter=',', newline='\r\n')
+    else:
+        # the csv module keeps the repr of floats and the quoting of text, the rows are encoded once at the end
+        text_buffer = io.StringIO(newline='')
+        writer = csv.writer(text_buffer)
+        writer.writerows(rows)
+        buffer.write(text_buffer.getvalue().encode('utf-8'))
     return buffer
 
 def create_hidden_link(bstream: io.BytesIO, file_name: str, file_type: str):
@@ -159,10 +248,9 @@ def create_hidden_link(bstream: io.BytesIO, file_name: str, file_type: str):
         the extension of the file.
 
     """
-    buffer = bstream.getbuffer()
-    nbuffer = len(buffer)
-    js_array = Uint8Array.new(nbuffer)
-    js_array.assign(buffer)
+    # getbuffer is a view of the stream, to_js copies it into a Uint8Array in one go without the getvalue copy
+    with bstream.getbuffer() as buf:
+        js_array = to_js(buf)
 
     file = File.new([js_array], file_name, {type: f"application/{file_type}"})
     url = URL.createObjectURL(file)
@@ -189,13 +277,13 @@ async def get_bytes_from_file(item) -> bytes:
     array_buf = await item.arrayBuffer()
     return array_buf.to_bytes()
 
-def rgb_falsecolors(vals: list[float], minval: float, mxval: float) -> list:
+def rgb_falsecolors(vals: list[float] | np.ndarray, minval: float, mxval: float) -> np.ndarray:
     """
     generate falsecolor values corresponding to the parameters.
 
     Parameters
     ----------
-    vals: list[float]
+    vals: list[float] | np.ndarray
         list[shape(n)], values to be converted to rgb of falsecolor.
     
     minval: float
@@ -206,12 +294,13 @@ def rgb_falsecolors(vals: list[float], minval: float, mxval: float) -> list:
 
     Returns
     -------
-    list
-        list[shape(nvals*3)] list of flat rgb colors. 
+    np.ndarray
+        np.ndarray[shape(nvals*3)] flat array of rgb colors. Values below minval or -inf get the min color, values above mxval or +inf get the max color and nan gets the min color.
     """
-    rgbs = geomie3d.utility.calc_falsecolour(vals, minval, mxval)
-    rgbs_flat = np.array(rgbs).flatten().tolist()
-    return rgbs_flat
+    # t is computed in float64 so that a small range on large values e.g. timestamps keeps its resolution
+    v = np.asarray(vals, dtype=np.float64).reshape(-1)
+    rgbs = _falsecolor_kernel(v, float(minval), float(mxval), _FC_LUT)
+    return rgbs.reshape(-1)
 
 def get_cam_place_from_xyzs(xyzs: list[list[float]], zoom_out_val: float = 0.0) -> list[list[float]]:
     """
@@ -230,9 +319,11 @@ def get_cam_place_from_xyzs(xyzs: list[list[float]], zoom_out_val: float = 0.0)
     list[list[float]]
         list[shape(2,3)], first points is the cam position, second point is the look at position.
     """
-    bbox = geomie3d.calculate.bbox_frm_xyzs(xyzs)
-    bbox_arr = bbox.bbox_arr
-    cam_pos = [bbox_arr[3] + zoom_out_val, bbox_arr[4] + zoom_out_val, bbox_arr[5] + zoom_out_val]
-    bbox_midpt = geomie3d.calculate.bboxes_centre([bbox])[0].tolist()
+    # the bbox and its centre straight from the min max of the points
+    xyzs = np.asarray(xyzs, dtype=np.float64)
+    mn = xyzs.min(axis=0)
+    mx = xyzs.max(axis=0)
+    cam_pos = (mx + zoom_out_val).tolist()
+    bbox_midpt = ((mn + mx) * 0.5).tolist()
     cam_place = [cam_pos, bbox_midpt]
     return cam_place
\ No newline at end of file
@@ -0,0 +1,59 @@
+import geomie3d
+import numpy as np
+import pytest
+
+from pyscript_3dapp_lib import _kernels
+
+def _geomie3d_falsecolor(vals, minval, mxval):
+    return np.array(geomie3d.utility.calc_falsecolour(list(vals), minval, mxval), dtype=np.float64)
+
+def _geomie3d_zxy(xyzs):
+    orig_cs = geomie3d.utility.CoordinateSystem([0,0,0], [1,0,0], [0,1,0])
+    dest_cs = geomie3d.utility.CoordinateSystem([0,0,0], [0,0,1], [1,0,0])
+    trsf_mat = geomie3d.calculate.cs2cs_matrice(orig_cs, dest_cs)
+    return np.asarray(geomie3d.calculate.trsf_xyzs(xyzs, trsf_mat))
+
+def _falsecolor(kernel, vals, minval, mxval):
+    return kernel(np.asarray(vals, dtype=np.float64), float(minval), float(mxval), _kernels._FC_LUT)
+
+@pytest.mark.parametrize('vals, minval, mxval', [
+    (np.random.default_rng(0).uniform(-5, 15, 100), 0, 10),
+    ([1e7 + 0.25, 1e7 + 0.5, 1e7 + 0.75], 1e7, 1e7 + 1),
+    ([4.0, 5.0, 6.0], 5, 5),
+])
+def test_falsecolor_matches_geomie3d(vals, minval, mxval):
+    # the lut has 1024 entries, the colors are within one lut step of geomie3d
+    expected = _geomie3d_falsecolor(vals, minval, mxval)
+    for kernel in (_kernels._falsecolor_kernel, _kernels._falsecolor_numpy):
+        rgbs = _falsecolor(kernel, vals, minval, mxval)
+        assert rgbs.dtype == np.float32
+        assert rgbs.shape == (len(vals), 3)
+        np.testing.assert_allclose(rgbs, expected, atol=5e-3)
+
+def test_falsecolor_float64_precision():
+    rgbs = _falsecolor(_kernels._falsecolor_kernel, [1e7 + 0.25, 1e7 + 0.5, 1e7 + 0.75], 1e7, 1e7 + 1)
+    assert len(np.unique(rgbs, axis=0)) == 3
+
+def test_falsecolor_nan_inf():
+    vals = [np.nan, -np.inf, np.inf, 5.0]
+    lut = _kernels._FC_LUT
+    expected = np.array([lut[0], lut[0], lut[-1], lut[len(lut) // 2]])
+    for minval, mxval in ((0, 10), (5, 5)):
+        rgbs = _falsecolor(_kernels._falsecolor_kernel, vals, minval, mxval)
+        np.testing.assert_array_equal(rgbs, _falsecolor(_kernels._falsecolor_numpy, vals, minval, mxval))
+    np.testing.assert_array_equal(_falsecolor(_kernels._falsecolor_kernel, vals, 0, 10), expected)
+
+def test_falsecolor_empty():
+    assert _falsecolor(_kernels._falsecolor_kernel, [], 0, 1).shape == (0, 3)
+
+@pytest.mark.parametrize('xyzs', [
+    np.array([1.0, 2.0, 3.0]),
+    np.random.default_rng(1).uniform(-10, 10, (50, 3)),
+    np.random.default_rng(2).uniform(-10, 10, (50, 3)).astype(np.float32),
+])
+def test_permute_zxy_matches_geomie3d(xyzs):
+    pts = xyzs.reshape(-1, 3)
+    trsf_xyzs = _kernels._permute_zxy(pts)
+    assert trsf_xyzs.dtype == pts.dtype
+    np.testing.assert_array_equal(trsf_xyzs, _kernels._permute_zxy_numpy(pts))
+    np.testing.assert_allclose(trsf_xyzs, _geomie3d_zxy(pts.astype(np.float64)), atol=1e-6)